@@ -23,7 +23,7 @@
 
 import argparse
 import logging
-import select
+import selectors
 import sys
 import time
 
@@ -100,19 +100,24 @@ if __name__ == "__main__":
     unchanged_sels = 0
     start_time = time.monotonic()
 
+    # Wait for all sockets of all nodes in one selector
+    selector = selectors.DefaultSelector()
+    for node in nodes:
+        for sock in node.get_descriptors():
+            selector.register(sock, selectors.EVENT_READ, node)
+
     while True:
-        descriptors = []
-        timeout = 1e10
-        for node in nodes:
-            timeout = min(timeout, node.get_timeout())
-            descriptors += node.get_descriptors()
+        timeout = min(node.get_timeout() for node in nodes)
 
-        rlist, _, _ = select.select(descriptors, [], [], timeout)
+        events = selector.select(timeout)
 
+        # Process only nodes which have a readable socket or an expired timer
+        ready_nodes = set(key.data for key, _ in events)
         for node in nodes:
-            node.process_events(wait=False)
+            if node in ready_nodes or node.get_timeout() <= 0.0:
+                node.process_events(wait=False)
 
-        if not rlist:
+        if not events:
             print("Selection at {:.1f}:".format(time.monotonic() - start_time))
 
             sels = []
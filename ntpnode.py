@@ -27,7 +27,7 @@ import enum
 import ipaddress
 import logging
 import random
-import select
+import selectors
 import socket
 import struct
 import sys
@@ -62,6 +62,11 @@ class Ntp5Flag(enum.IntEnum):
     INTERLEAVED = 0x2
     AUTH_NAK = 0x4
 
+# Valid values of header fields checked in decoding, which keeps them as
+# plain integers
+NTP_MODES = frozenset(NtpMode)
+NTP5_TIMESCALES = frozenset(Ntp5Timescale)
+
 class NtpEF(enum.IntEnum):
     PADDING = 0xf501
     MAC = 0xf502
@@ -76,20 +81,76 @@ class NtpEF(enum.IntEnum):
 
 OUR_DRAFT_ID = "draft-ietf-ntp-ntpv5-02+"
 
+# Length of the shortest valid NTPv5 message (header and draft ID)
+NTP5_MIN_LENGTH = 48 + ((4 + len(OUR_DRAFT_ID) + 3) & ~3)
+
 REFERENCE_IDS_OCTETS = 4096 // 8
+EMPTY_REFERENCE_IDS = bytes(REFERENCE_IDS_OCTETS)
+
+MAX_MESSAGE_LENGTH = 1024
+
+NTP5_HEADER = struct.Struct("!BBbbBBHIIQQQQ")
+NTP4_HEADER = struct.Struct("!BBbbIIIQQQQ")
+
+EF_HEADER = struct.Struct("!HH")
+EF_SERVER_INFO = struct.Struct("!HH")
+EF_REFERENCE_IDS_REQ = struct.Struct("!H")
+EF_REFERENCE_TS = struct.Struct("!Q")
+EF_SECONDARY_RX_TS = struct.Struct("!BBHQ")
 
 class Ntp4MagicRefTs(enum.IntEnum):
     NTP5 = struct.unpack("!Q", b"NTP5DRFT")[0]
 
-def read_clock(precision):
-    return int((time.time() + 0x83aa7e80) * 4294967296) ^ \
-           int(random.getrandbits(32 + precision))
+# Offset between the NTP and Unix epochs in nanoseconds
+NTP_EPOCH_OFFSET_NS = 0x83aa7e80 * 1000000000
+
+def make_timestamp(ns, precision):
+    # Convert the time in integer nanoseconds to not lose resolution
+    return (((ns + NTP_EPOCH_OFFSET_NS) << 32) // 1000000000) ^ random.getrandbits(32 + precision)
 
-@dataclass
+def read_clock(precision):
+    return make_timestamp(time.time_ns(), precision)
+
+# Kernel receive timestamps (Linux only, the socket module does not define
+# SO_TIMESTAMPNS in all Python versions, and some systems do not support
+# ancillary data at all)
+RX_TIMESTAMPS = hasattr(socket, "CMSG_SPACE")
+# The fallback is the asm-generic value used by most architectures, some
+# (e.g. parisc, sparc) have a different value
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+TIMESPEC = struct.Struct("@ll")
+RX_TIMESTAMP_ANCDATA_SIZE = socket.CMSG_SPACE(TIMESPEC.size) if RX_TIMESTAMPS else 0
+
+def enable_rx_timestamps(sock):
+    if not RX_TIMESTAMPS or not sys.platform.startswith("linux"):
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except OSError as e:
+        logging.error("Could not enable kernel receive timestamps: {}".format(e))
+
+def receive_message(sock, precision):
+    if not RX_TIMESTAMPS:
+        message, address = sock.recvfrom(MAX_MESSAGE_LENGTH)
+        return message, address, read_clock(precision)
+
+    message, ancdata, _, address = sock.recvmsg(MAX_MESSAGE_LENGTH, RX_TIMESTAMP_ANCDATA_SIZE)
+
+    # Prefer the kernel timestamp, which does not include the scheduling
+    # delay of the process
+    for level, cmsg_type, data in ancdata:
+        if level == socket.SOL_SOCKET and cmsg_type == SO_TIMESTAMPNS and len(data) >= TIMESPEC.size:
+            sec, nsec = TIMESPEC.unpack_from(data)
+            return message, address, make_timestamp(sec * 1000000000 + nsec, precision)
+
+    return message, address, read_clock(precision)
+
+# Decoded messages hold plain integers instead of the enums
+@dataclass(slots=True)
 class NtpMessage:
     # Both NTPv5 and NTPv4
     version: int
-    mode: NtpMode
+    mode: int # NtpMode
     stratum: int
     poll: int
     precision: int
@@ -99,15 +160,15 @@ class NtpMessage:
     transmit_ts: int
 
     # NTPv5-specific
-    leap5: Ntp5Leap
-    timescale: Ntp5Timescale
+    leap5: int # Ntp5Leap
+    timescale: int # Ntp5Timescale
     era: int
     flags: int
     server_cookie: int
     client_cookie: int
 
     # NTPv4-specific
-    leap4: Ntp4Leap
+    leap4: int # Ntp4Leap
     reference_id: int
     reference_ts: int
     origin_ts: int
@@ -128,24 +189,27 @@ class NtpMessage:
         lvm = message[0]
 
         version = (lvm >> 3) & 7
-        mode = NtpMode(lvm & 7)
+        mode = lvm & 7
+        if mode not in NTP_MODES:
+            raise ValueError("Invalid mode {}".format(mode))
 
         if version == 5:
-            leap5 = Ntp5Leap(lvm >> 6)
+            leap5 = lvm >> 6
             leap4 = None
             _, stratum, poll, precision, timescale, era, flags, \
                 root_delay, root_disp, server_cookie, client_cookie, receive_ts, transmit_ts = \
-                     struct.unpack("!BBbbBBHIIQQQQ", message[:48])
-            timescale = Ntp5Timescale(timescale)
+                     NTP5_HEADER.unpack_from(message)
+            if timescale not in NTP5_TIMESCALES:
+                raise ValueError("Invalid timescale {}".format(timescale))
             root_delay = root_delay / 2**28
             root_disp = root_disp / 2**28
             reference_id = reference_ts = origin_ts = None
         elif version == 4:
-            leap4 = Ntp4Leap(lvm >> 6)
+            leap4 = lvm >> 6
             leap5 = None
             _, stratum, poll, precision, root_delay, root_disp, reference_id, \
                 reference_ts, origin_ts, receive_ts, transmit_ts = \
-                     struct.unpack("!BBbbIIIQQQQ", message[:48])
+                     NTP4_HEADER.unpack_from(message)
             timescale = Ntp5Timescale.UTC
             era = flags = server_cookie = client_cookie = None
             root_delay = root_delay / 2**16
@@ -153,40 +217,44 @@ class NtpMessage:
         else:
             raise ValueError("Invalid version {}".format(version))
 
-        extensions = message[48:]
         server_info = reference_ids_req = reference_ids_resp = reference_ts_ = None
         secondary_rx_ts = draft_id = None
 
-        while len(extensions) > 0:
+        # Walk the extension fields in place without copying the rest of
+        # the message on each step
+        offset = 48
+        end = len(message)
+
+        while offset < end:
             # Ignore NTPv4 MAC
-            if version == 4 and len(extensions) <= 24:
+            if version == 4 and end - offset <= 24:
                 break
-            (ef_type, ef_len) = struct.unpack("!HH", extensions[:4])
-            if ef_len > len(extensions) or ef_len < 4 or \
+            (ef_type, ef_len) = EF_HEADER.unpack_from(message, offset)
+            if offset + ef_len > end or ef_len < 4 or \
                     (version == 4 and (ef_len < 16 or ef_len % 4 != 0)):
                 raise ValueError("Invalid format")
 
             if ef_type == NtpEF.REFERENCE_IDS_REQ:
-                reference_ids_req = (struct.unpack("!H", extensions[4:6])[0], ef_len - 4)
+                reference_ids_req = (EF_REFERENCE_IDS_REQ.unpack_from(message, offset + 4)[0], ef_len - 4)
             elif ef_type == NtpEF.REFERENCE_IDS_RESP:
-                reference_ids_resp = extensions[4:ef_len]
+                reference_ids_resp = message[offset + 4:offset + ef_len]
             elif ef_type == NtpEF.SERVER_INFO and ef_len == 8:
-                server_info = struct.unpack("!H", extensions[4:6])[0]
+                server_info = EF_SERVER_INFO.unpack_from(message, offset + 4)[0]
             elif ef_type == NtpEF.REFERENCE_TS and ef_len == 12:
-                reference_ts_ = struct.unpack("!Q", extensions[4:12])[0]
+                reference_ts_ = EF_REFERENCE_TS.unpack_from(message, offset + 4)[0]
             elif ef_type == NtpEF.SECONDARY_RX_TS and ef_len == 16:
-                sec_scale, sec_era, _, sec_ts = struct.unpack("!BBHQ", extensions[4:16])
+                sec_scale, sec_era, _, sec_ts = EF_SECONDARY_RX_TS.unpack_from(message, offset + 4)
                 if sec_scale in (Ntp5Timescale.UTC, ):
                     if secondary_rx_ts is None:
                         secondary_rx_ts = {}
-                    secondary_rx_ts[Ntp5Timescale(sec_scale)] = (sec_era, sec_ts)
+                    secondary_rx_ts[sec_scale] = (sec_era, sec_ts)
             elif ef_type == NtpEF.DRAFT_ID:
                 try:
-                    draft_id = extensions[4:ef_len].decode('ascii')
+                    draft_id = message[offset + 4:offset + ef_len].decode('ascii')
                 except UnicodeDecodeError:
                     pass
 
-            extensions = extensions[(ef_len + 3) & 0xfffc:]
+            offset += (ef_len + 3) & 0xfffc
 
         if version == 5:
             if draft_id is None:
@@ -200,59 +268,80 @@ class NtpMessage:
                    server_info, reference_ids_req, reference_ids_resp, reference_ts_,
                    secondary_rx_ts, draft_id)
 
-    def get_rint(self, value):
-        if self.version == 5:
-            return min(int(value * 2**28), 0xffffffff)
-        else:
-            return min(int(value * 2**16), 0xffffffff)
-
-    def encode_ef(self, ef_type, ef_body):
-        pad_len = 0 if len(ef_body) % 4 == 0 else 4 - len(ef_body) % 4
-        return struct.pack("!HH", ef_type, 4 + len(ef_body)) + ef_body + b"\x00" * pad_len
+    def encode_ef(self, buf, offset, ef_type, ef_body_len):
+        # The body needs to be already written in the buffer
+        EF_HEADER.pack_into(buf, offset, ef_type, 4 + ef_body_len)
+        end = offset + 4 + ef_body_len
+        pad_len = -end % 4
+        if pad_len > 0:
+            buf[end:end + pad_len] = b"\x00" * pad_len
+        return end + pad_len
 
     def encode(self, target_len=0):
-        stratum = self.stratum if self.stratum < 16 else 0
+        buf = bytearray(max(target_len, MAX_MESSAGE_LENGTH))
+        return bytes(memoryview(buf)[:self.encode_into(buf, target_len)])
+
+    def encode_into(self, buf, target_len=0):
+        # Write the message to the start of the buffer, which may contain
+        # data from a previous message, and return its length
         if self.version == 5:
-            header = struct.pack("!BBbbBBHIIQQQQ",
-                                 (self.leap5 << 6) | (self.version << 3) | self.mode, stratum,
-                                 self.poll, self.precision, self.timescale, self.era, self.flags,
-                                 self.get_rint(self.root_delay), self.get_rint(self.root_disp),
-                                 self.server_cookie, self.client_cookie, self.receive_ts, self.transmit_ts)
+            return self.encode5(buf, target_len)
         elif self.version == 4:
-            header = struct.pack("!BBbbIIIQQQQ",
-                                 (self.leap4 << 6) | (self.version << 3) | self.mode, stratum,
-                                 self.poll, self.precision, self.get_rint(self.root_delay),
-                                 self.get_rint(self.root_disp), self.reference_id, self.reference_ts,
-                                 self.origin_ts, self.receive_ts, self.transmit_ts)
+            return self.encode4(buf)
         else:
             assert False
 
-        message = header
+    def encode4(self, buf):
+        # NTPv4 messages are sent without extension fields
+        NTP4_HEADER.pack_into(buf, 0, (self.leap4 << 6) | (4 << 3) | self.mode,
+                              self.stratum if self.stratum < 16 else 0, self.poll, self.precision,
+                              min(int(self.root_delay * 2**16), 0xffffffff),
+                              min(int(self.root_disp * 2**16), 0xffffffff),
+                              self.reference_id, self.reference_ts, self.origin_ts,
+                              self.receive_ts, self.transmit_ts)
+        return NTP4_HEADER.size
+
+    def encode5(self, buf, target_len):
+        NTP5_HEADER.pack_into(buf, 0, (self.leap5 << 6) | (5 << 3) | self.mode,
+                              self.stratum if self.stratum < 16 else 0, self.poll, self.precision,
+                              self.timescale, self.era, self.flags,
+                              min(int(self.root_delay * 2**28), 0xffffffff),
+                              min(int(self.root_disp * 2**28), 0xffffffff),
+                              self.server_cookie, self.client_cookie, self.receive_ts, self.transmit_ts)
+        offset = NTP5_HEADER.size
 
         if self.server_info is not None:
-            message += self.encode_ef(NtpEF.SERVER_INFO,
-                                      struct.pack("!HH", self.server_info, 0))
+            EF_SERVER_INFO.pack_into(buf, offset + 4, self.server_info, 0)
+            offset = self.encode_ef(buf, offset, NtpEF.SERVER_INFO, EF_SERVER_INFO.size)
         if self.reference_ids_req is not None:
-            message += self.encode_ef(NtpEF.REFERENCE_IDS_REQ,
-                    struct.pack("!H", self.reference_ids_req[0]) + (self.reference_ids_req[1] - 2) * " ".encode())
+            body_len = self.reference_ids_req[1]
+            EF_REFERENCE_IDS_REQ.pack_into(buf, offset + 4, self.reference_ids_req[0])
+            buf[offset + 6:offset + 4 + body_len] = (body_len - 2) * b" "
+            offset = self.encode_ef(buf, offset, NtpEF.REFERENCE_IDS_REQ, body_len)
         if self.reference_ids_resp is not None:
-            message += self.encode_ef(NtpEF.REFERENCE_IDS_RESP, self.reference_ids_resp)
+            body_len = len(self.reference_ids_resp)
+            buf[offset + 4:offset + 4 + body_len] = self.reference_ids_resp
+            offset = self.encode_ef(buf, offset, NtpEF.REFERENCE_IDS_RESP, body_len)
         if self.reference_ts_ is not None:
-            message += self.encode_ef(NtpEF.REFERENCE_TS, struct.pack("!Q", self.reference_ts_))
+            EF_REFERENCE_TS.pack_into(buf, offset + 4, self.reference_ts_)
+            offset = self.encode_ef(buf, offset, NtpEF.REFERENCE_TS, EF_REFERENCE_TS.size)
         if self.secondary_rx_ts is not None:
             for timescale, (era, ts) in self.secondary_rx_ts.items():
-                message += self.encode_ef(NtpEF.SECONDARY_RX_TS,
-                                          struct.pack("!BBHQ", timescale, era, 0, ts))
+                EF_SECONDARY_RX_TS.pack_into(buf, offset + 4, timescale, era, 0, ts)
+                offset = self.encode_ef(buf, offset, NtpEF.SECONDARY_RX_TS, EF_SECONDARY_RX_TS.size)
         if self.draft_id is not None:
-            message += self.encode_ef(NtpEF.DRAFT_ID, self.draft_id.encode('ascii'))
+            draft_id = self.draft_id.encode('ascii')
+            buf[offset + 4:offset + 4 + len(draft_id)] = draft_id
+            offset = self.encode_ef(buf, offset, NtpEF.DRAFT_ID, len(draft_id))
 
-        if len(message) < target_len and self.version == 5:
-            assert len(message) + 4 <= target_len
-            message += self.encode_ef(NtpEF.PADDING, b'\x00' * (target_len - len(message) - 4))
+        if offset < target_len:
+            assert offset + 4 <= target_len
+            buf[offset + 4:target_len] = bytes(target_len - offset - 4)
+            offset = self.encode_ef(buf, offset, NtpEF.PADDING, target_len - offset - 4)
 
-        return message
+        return offset
 
-@dataclass
+@dataclass(slots=True)
 class NtpSample:
     offset: float
     delay: float
@@ -262,7 +351,9 @@ class NtpSample:
     stratum: int
 
 class NtpClient:
-    def __init__(self, dispersion_rate, version, interleaved, refids_fragments):
+    def __init__(self, address, dispersion_rate, version, interleaved, refids_fragments):
+        # Address of the server (the peer of the connected socket)
+        self.address = address
         self.dispersion_rate = dispersion_rate
         self.precision = -20
         if version in (4, 5):
@@ -272,12 +363,12 @@ class NtpClient:
             self.version = 4
             self.auto_version = True
         self.interleaved = interleaved
-        self.refids_fragments = refids_fragments
+        self.refids_fragment_len = REFERENCE_IDS_OCTETS // refids_fragments
         self.timescale = Ntp5Timescale.UTC
 
         self.missed_responses = 0
 
-        self.reference_ids = 0
+        self.reference_ids = bytearray(REFERENCE_IDS_OCTETS)
         self.next_refids_fragment = 0
         self.complete_refids = False
 
@@ -312,8 +403,8 @@ class NtpClient:
                 server_cookie = 0
             client_cookie = random.getrandbits(64)
             server_info = 0
-            reference_ids_req = (self.next_refids_fragment * (REFERENCE_IDS_OCTETS // self.refids_fragments),
-                                 (REFERENCE_IDS_OCTETS // self.refids_fragments))
+            reference_ids_req = (self.next_refids_fragment * self.refids_fragment_len,
+                                 self.refids_fragment_len)
             reference_ts_ = 0
             secondary_rx_ts = {timescale: (0, 0)}
             draft_id = OUR_DRAFT_ID
@@ -351,16 +442,14 @@ class NtpClient:
         message = self.last_request.encode()
         sock.send(message)
         logging.info("Sent NTPv{} request ({}) to {}".format(self.last_request.version, len(message),
-                                                             sock.getpeername()))
-        logging.debug("  {}".format(self.last_request))
+                                                             self.address))
+        logging.debug("  %s", self.last_request)
 
     def merge_refids_fragment(self, fragment):
-        start = self.next_refids_fragment * (REFERENCE_IDS_OCTETS // self.refids_fragments)
-        end = min(REFERENCE_IDS_OCTETS, start + (REFERENCE_IDS_OCTETS // self.refids_fragments))
-        mask = (((1 << (8 * start)) - 1) << (8 * (REFERENCE_IDS_OCTETS - start))) | \
-                ((1 << (8 * (REFERENCE_IDS_OCTETS - end))) - 1)
-        self.reference_ids = (self.reference_ids & mask) | \
-                             (fragment << ((REFERENCE_IDS_OCTETS - end) * 8))
+        start = self.next_refids_fragment * self.refids_fragment_len
+        end = min(REFERENCE_IDS_OCTETS, start + self.refids_fragment_len)
+        # Keep the size of the filter if the fragment has an unexpected length
+        self.reference_ids[start:end] = fragment[start - end:].rjust(end - start, b"\x00")
         if end < REFERENCE_IDS_OCTETS:
             self.next_refids_fragment += 1
         else:
@@ -369,13 +458,11 @@ class NtpClient:
 
     def receive_response(self, sock):
         try:
-            message = sock.recv(1024)
+            message, _, receive_ts = receive_message(sock, self.precision)
         except Exception as e:
-            logging.error("Could not receive response from {}: {}".format(sock.getpeername(), e))
+            logging.error("Could not receive response from {}: {}".format(self.address, e))
             return
 
-        receive_ts = read_clock(self.precision)
-
         try:
             response = NtpMessage.decode(message)
         except ValueError as e:
@@ -383,8 +470,8 @@ class NtpClient:
             return
 
         logging.info("Received NTPv{} response ({}) from {}".format(response.version, len(message),
-                                                                  sock.getpeername()))
-        logging.debug("  {}".format(response))
+                                                                  self.address))
+        logging.debug("  %s", response)
 
         # Ignore unexpected responses
         if self.missed_responses == 0 or response.mode != NtpMode.SERVER:
@@ -403,12 +490,9 @@ class NtpClient:
             else:
                 logging.info("  Bogus response")
                 return
-            self.reference_ids = 0
         else:
             return
 
-        self.reference_id = response.reference_id
-
         if (response.version == 5 and not response.flags & Ntp5Flag.SYNCHRONIZED) or \
                 (response.version == 4 and not response.leap4 != Ntp4Leap.UNSYNCHRONIZED) or \
                 response.stratum == 0 or \
@@ -420,12 +504,17 @@ class NtpClient:
             logging.info("  Unsupported timescale")
             return
 
+        # Update the loop-detection state only with accepted responses
+        self.reference_id = response.reference_id
+
         if response.version == 5:
             if response.reference_ids_resp is not None:
-                self.merge_refids_fragment(int.from_bytes(response.reference_ids_resp, byteorder='big'))
+                self.merge_refids_fragment(response.reference_ids_resp)
             else:
                 # Server cannot be synchronized to other servers (no loop)
-                self.reference_ids = 0
+                self.reference_ids[:] = EMPTY_REFERENCE_IDS
+        else:
+            self.reference_ids[:] = EMPTY_REFERENCE_IDS
 
         if interleaved:
             T1 = self.prev_transmit_ts
@@ -438,8 +527,11 @@ class NtpClient:
             T3 = response.transmit_ts
             T4 = receive_ts
 
-        offset = 0.5 * ((T2 - T1) + (T3 - T4)) / 2**32
-        delay = abs((T4 - T1) - (T3 - T2)) / 2**32
+        # Compute both offset and delay from the same two differences
+        d1 = T2 - T1
+        d2 = T3 - T4
+        offset = (d1 + d2) / 2**33
+        delay = abs(d1 - d2) / 2**32
 
         self.sample = NtpSample(offset, delay, delay * self.dispersion_rate,
                                 delay + response.root_delay, delay * self.dispersion_rate +
@@ -460,30 +552,35 @@ class NtpClient:
 
 class NtpServer:
     def __init__(self, dispersion_rate, local_reference):
-        # Map of server cookie -> transmit timestamp
-        self.saved_timestamps = {}
-
-        # Queue of cookies to be removed from the map to limit its size
-        self.timestamp_queue = collections.deque()
+        # Map of server cookie -> transmit timestamp, ordered from the
+        # oldest to allow removing old entries to limit its size
+        self.saved_timestamps = collections.OrderedDict()
         self.max_timestamps = 1000
 
-        self.dispersion_rate = dispersion_rate
+        # Maximum number of requests received from a socket per event
+        self.max_batch_requests = 64
+
+        # Buffer reused for encoding responses
+        self.response_buffer = bytearray(MAX_MESSAGE_LENGTH)
+
+        # Dispersion per unit of the 32.32 timestamps
+        self.timestamp_dispersion_rate = dispersion_rate / 2**32
         self.precision = -20
         self.root_delay = 0.0
         self.root_disp = 0.0
         self.reference_ts = read_clock(self.precision)
 
-        self.own_reference_id = 0
-        for i in range(10):
-            self.own_reference_id |= 1 << random.randint(0, REFERENCE_IDS_OCTETS * 8 - 1)
-        self.reference_ids = self.own_reference_id
+        own_reference_id = bytearray(REFERENCE_IDS_OCTETS)
+        for bit in random.sample(range(REFERENCE_IDS_OCTETS * 8), 10):
+            own_reference_id[bit >> 3] |= 1 << (bit & 7)
+        self.own_reference_id = bytes(own_reference_id)
 
         if local_reference:
-            self.set_reference(1, 0x7f7f0001, 0, 0, 0.0, 0.0)
+            self.set_reference(1, 0x7f7f0001, [], 0, 0.0, 0.0)
         else:
-            self.set_reference(0, 0, 0, 0, 0.0, 0.0)
+            self.set_reference(0, 0, [], 0, 0.0, 0.0)
 
-    def set_reference(self, stratum, reference_id, reference_ids, reference_ts,
+    def set_reference(self, stratum, reference_id, sources_reference_ids, reference_ts,
                       root_delay, root_disp):
         if stratum > 0:
             self.leap4 = Ntp4Leap.NORMAL
@@ -495,11 +592,21 @@ class NtpServer:
             self.flags = 0
         self.stratum = stratum
         self.reference_id = reference_id
-        self.reference_ids = self.own_reference_id | reference_ids
+
+        # Combine the own reference ID with the filters of all selected
+        # sources in one pass
+        reference_ids = int.from_bytes(self.own_reference_id, byteorder='big')
+        for source_reference_ids in sources_reference_ids:
+            reference_ids |= int.from_bytes(source_reference_ids, byteorder='big')
+        self.reference_ids = reference_ids.to_bytes(REFERENCE_IDS_OCTETS, byteorder='big')
         self.reference_ts = reference_ts
         self.root_delay = root_delay
         self.root_disp = root_disp
 
+    def contains_own_reference_id(self, reference_ids):
+        own_reference_id = int.from_bytes(self.own_reference_id, byteorder='big')
+        return own_reference_id & int.from_bytes(reference_ids, byteorder='big') == own_reference_id
+
     def make_response(self, request, receive_ts, transmit_ts):
         timescale = era = flags = server_cookie = client_cookie = None
         reference_id = reference_ts = origin_ts = None
@@ -507,7 +614,7 @@ class NtpServer:
 
         root_disp = self.root_disp
         if self.stratum > 1:
-            root_disp += abs(transmit_ts - self.reference_ts) / 2**32 * self.dispersion_rate
+            root_disp += abs(transmit_ts - self.reference_ts) * self.timestamp_dispersion_rate
 
         if request.version == 5:
             timescale = Ntp5Timescale.UTC
@@ -526,8 +633,8 @@ class NtpServer:
             if request.server_info is not None:
                 server_info = (1 << 4 - 1) | (1 << 5 - 1)
             if request.reference_ids_req is not None:
-                reference_ids_resp = self.reference_ids.to_bytes(REFERENCE_IDS_OCTETS, byteorder='big') \
-                        [request.reference_ids_req[0]:sum(request.reference_ids_req)]
+                reference_ids_resp = self.reference_ids[request.reference_ids_req[0]:
+                                                        sum(request.reference_ids_req)]
             if request.reference_ts_ is not None:
                 reference_ts_ = self.reference_ts
             if request.secondary_rx_ts is not None:
@@ -564,19 +671,29 @@ class NtpServer:
 
     def save_timestamps(self, receive_ts, transmit_ts):
         assert(receive_ts not in self.saved_timestamps)
-        assert(len(self.saved_timestamps) <= self.max_timestamps)
-        assert(len(self.saved_timestamps) <= len(self.timestamp_queue))
 
         self.saved_timestamps[receive_ts] = transmit_ts
 
-        self.timestamp_queue.append(receive_ts)
-        if len(self.timestamp_queue) > self.max_timestamps:
-            self.saved_timestamps.pop(self.timestamp_queue[0], 0)
-            self.timestamp_queue.popleft()
+        if len(self.saved_timestamps) > self.max_timestamps:
+            self.saved_timestamps.popitem(last=False)
 
-    def receive_request(self, sock):
-        message, address = sock.recvfrom(1024)
-        receive_ts = read_clock(self.precision)
+    def receive_requests(self, sock):
+        # Process all requests waiting in the (non-blocking) socket after
+        # one wakeup, but limit the batch to not delay other events
+        for _ in range(self.max_batch_requests):
+            try:
+                message, address, receive_ts = receive_message(sock, self.precision)
+            except BlockingIOError:
+                break
+            self.receive_request(sock, message, address, receive_ts)
+
+    def receive_request(self, sock, message, address, receive_ts):
+        # Drop packets that cannot be valid requests without decoding them
+        if len(message) < 48 or len(message) % 4 != 0 or message[0] & 7 != NtpMode.CLIENT:
+            return
+        version = (message[0] >> 3) & 7
+        if version != 4 and (version != 5 or len(message) < NTP5_MIN_LENGTH):
+            return
 
         # Avoid conflict with a previous receive timestamp, e.g. after
         # a backward step of the clock
@@ -592,10 +709,7 @@ class NtpServer:
         request_len = len(message)
 
         logging.info("Received NTPv{} request ({}) from {}".format(request.version, request_len, address))
-        logging.debug("  {}".format(request))
-
-        if request.mode != NtpMode.CLIENT:
-            return
+        logging.debug("  %s", request)
 
         while True:
             pre_transmit_ts = read_clock(self.precision)
@@ -608,20 +722,20 @@ class NtpServer:
         # This should be a more accurate transmit timestamp of the response
         transmit_ts = read_clock(self.precision)
 
-        message = response.encode(target_len=request_len)
+        response_len = response.encode_into(self.response_buffer, target_len=request_len)
 
-        if len(message) > request_len:
+        if response_len > request_len:
             logging.error("Not sending response longer than request!")
             return
         try:
-            sock.sendto(message, address)
+            sock.sendto(memoryview(self.response_buffer)[:response_len], address)
         except Exception as e:
             logging.error("Could not sent response to {}: {}".format(address, e))
-            logging.debug("  {}".format(response))
+            logging.debug("  %s", response)
             return
 
-        logging.info("Sent NTPv{} response ({}) to {}".format(response.version, len(message), address))
-        logging.debug("  {}".format(response))
+        logging.info("Sent NTPv{} response ({}) to {}".format(response.version, response_len, address))
+        logging.debug("  %s", response)
 
         self.save_timestamps(receive_ts, transmit_ts)
 
@@ -641,6 +755,9 @@ class NtpNode:
         self.selection_delays = {}
         self.selected_sources = []
 
+        # Sockets are registered with the function processing their events
+        self.selector = selectors.DefaultSelector()
+
         for server in servers:
             if ':' in server:
                 hostname = server.split(':')[0]
@@ -651,8 +768,10 @@ class NtpNode:
             for family, _, _, _, sockaddr in socket.getaddrinfo(hostname, port, family=socket.AF_INET):
                 sock = socket.socket(family, socket.SOCK_DGRAM)
                 sock.connect(sockaddr)
-                self.clients[sock] = NtpClient(dispersion_rate, version, interleaved, refids_fragments)
-                self.own_addresses.add(sock.getsockname()[0])
+                enable_rx_timestamps(sock)
+                self.clients[sock] = NtpClient(sockaddr, dispersion_rate, version, interleaved, refids_fragments)
+                self.selector.register(sock, selectors.EVENT_READ, self.clients[sock].receive_response)
+                self.own_addresses.add(int(ipaddress.IPv4Address(sock.getsockname()[0])))
                 self.selection_delays[sockaddr] = 0
                 break
             else:
@@ -660,49 +779,51 @@ class NtpNode:
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.bind(("0.0.0.0", own_port))
+        sock.setblocking(False)
+        enable_rx_timestamps(sock)
 
         self.server_sockets = [sock]
         self.server = NtpServer(dispersion_rate, local_reference)
+        self.selector.register(sock, selectors.EVENT_READ, self.server.receive_requests)
 
     def select_sources(self):
         logging.info("Selecting sources:")
 
         selected_sources = []
-        for sock, client in self.clients.items():
-            address = sock.getpeername()
+        for client in self.clients.values():
+            address = client.address
 
             if self.selection_delays[address] > 0:
                 self.selection_delays[address] -= 1
 
             if client.sample is None:
                 logging.info("  {}: Not selected (missing sample)".format(address))
-            elif client.sample.root_delay / 2 + client.sample.root_disp > self.max_distance:
+            elif (distance := client.sample.root_delay / 2 + client.sample.root_disp) > self.max_distance:
                 logging.info("  {}: Not selected (distance too large)".format(address))
             elif client.version == 5 and not client.complete_refids:
                 logging.info("  {}: Not selected (waiting for complete refids)".format(address))
-            elif self.server.own_reference_id & client.reference_ids == self.server.own_reference_id or \
-                 (not self.no_refid_loop and client.reference_id is not None and \
-                  str(ipaddress.IPv4Address(client.reference_id)) in self.own_addresses):
+            elif self.server.contains_own_reference_id(client.reference_ids) or \
+                 (not self.no_refid_loop and client.reference_id in self.own_addresses):
                 logging.info("  {}: Not selected (synchronization loop)".format(address))
                 self.selection_delays[address] = random.randint(1, 4)
             elif self.selection_delays[address] > 0:
                 logging.info("  {}: Not selected (recently in loop)".format(address))
             else:
-                selected_sources.append((address, client.sample, client.reference_ids))
+                # Save the sorting key to not compute the distance again
+                selected_sources.append((distance + 0.001 * client.sample.stratum,
+                                         address, client.sample, client.reference_ids))
 
             client.sample = None
 
-        selected_sources.sort(key=lambda s: s[1].root_delay / 2 + s[1].root_disp + 0.001 * s[1].stratum)
-        self.selected_sources = [s[0] for s in selected_sources]
+        selected_sources.sort(key=lambda s: s[0])
+        self.selected_sources = [s[1] for s in selected_sources]
 
         if len(selected_sources) > 0:
-            selected_reference_ids = 0
-            for i, (address, sample, reference_ids) in enumerate(selected_sources):
+            for i, (_, address, sample, reference_ids) in enumerate(selected_sources):
                 logging.info("  {}: Selected #{}".format(address, i + 1))
-                selected_reference_ids |= reference_ids
             self.server.set_reference(sample.stratum + 1,
-                                      int(ipaddress.IPv4Address(selected_sources[0][0][0])),
-                                      selected_reference_ids,
+                                      int(ipaddress.IPv4Address(selected_sources[0][1][0])),
+                                      [s[3] for s in selected_sources],
                                       read_clock(self.server.precision),
                                       sample.root_delay,
                                       sample.root_disp)
@@ -715,13 +836,8 @@ class NtpNode:
 
     def process_events(self, wait=True):
         timeout = self.get_timeout() if wait else 0.0
-        rlist, _, _ = select.select(self.get_descriptors(), [], [], timeout)
-
-        for sock in rlist:
-            if sock in self.server_sockets:
-                self.server.receive_request(sock)
-            elif sock in self.clients:
-                self.clients[sock].receive_response(sock)
+        for key, _ in self.selector.select(timeout):
+            key.data(key.fileobj)
 
         if self.get_timeout() <= 0.0:
             self.select_sources()